@@ -2,15 +2,21 @@ import shutil
 import sys
 import os
 import csv
+import re
+import hashlib
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from cytomine.models import Job
 from subprocess import run
 from biaflows import CLASS_SPTCNT
 from biaflows.helpers import BiaflowsJob, prepare_data
 import time
-import cellprofiler_core.pipeline
-import cellprofiler_core.preferences
 
-cellprofiler_core.preferences.set_headless()
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 NUCLEI_MASK_KEY = "_Nuclei_Mask"
 AGGREGATES_MASK_KEY = "_Aggregates_Mask"
@@ -29,64 +35,247 @@ PARAMETER_SUFFIXES = {
     CELLS_MASK_KEY: "cells_mask_suffix"
 }
 
-
-def infer_column_type(values):
+# Rendered pipelines are cached on disk across jobs; entries only change
+# when the .cppipe file or the relevant parameters do
+CPPIPE_CACHE_DIR = "/tmp/cppipe_cache"
+CPPIPE_CACHE_SIZE = 32
+
+# Recognizers for column type inference, built once at import time; the
+# bound match methods avoid an attribute lookup per value
+_BOOL_SET = frozenset(('true', 'false'))
+_INT_MATCH = re.compile(r'^[-+]?\d+$').match
+_FLOAT_MATCH = re.compile(
+    r'^[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?$|^[-+]?(nan|inf)$',
+    re.IGNORECASE).match
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _value_type_mask(data, start, end):
+        """
+        Classifies the byte slice data[start:end] as a bitmask of the
+        categories it satisfies: 1 for bool, 2 for int, 4 for float.
+        Implements the same grammar as the module regexes ('true'/'false',
+        signed integers, decimals with optional exponent, nan/inf), all
+        case-insensitive via the | 32 lower-casing trick.
+        """
+        mask = 0
+        length = end - start
+
+        # 'true' or 'false'
+        if length == 4:
+            if ((data[start] | 32) == 116      # t
+                    and (data[start + 1] | 32) == 114  # r
+                    and (data[start + 2] | 32) == 117  # u
+                    and (data[start + 3] | 32) == 101):  # e
+                mask |= 1
+        elif length == 5:
+            if ((data[start] | 32) == 102      # f
+                    and (data[start + 1] | 32) == 97   # a
+                    and (data[start + 2] | 32) == 108  # l
+                    and (data[start + 3] | 32) == 115  # s
+                    and (data[start + 4] | 32) == 101):  # e
+                mask |= 1
+
+        pos = start
+        if data[pos] == 43 or data[pos] == 45:  # '+' or '-'
+            pos += 1
+        digits = 0
+        while pos < end and 48 <= data[pos] <= 57:
+            digits += 1
+            pos += 1
+        if digits > 0 and pos == end:
+            mask |= 2
+
+        valid = digits > 0
+        if pos < end and data[pos] == 46:  # '.'
+            pos += 1
+            fraction = 0
+            while pos < end and 48 <= data[pos] <= 57:
+                fraction += 1
+                pos += 1
+            valid = digits > 0 or fraction > 0
+        if valid and pos < end and (data[pos] | 32) == 101:  # e
+            pos += 1
+            if pos < end and (data[pos] == 43 or data[pos] == 45):
+                pos += 1
+            exponent = 0
+            while pos < end and 48 <= data[pos] <= 57:
+                exponent += 1
+                pos += 1
+            valid = exponent > 0
+        if valid and pos == end:
+            mask |= 4
+        else:
+            # nan/inf with optional sign
+            pos = start
+            if data[pos] == 43 or data[pos] == 45:
+                pos += 1
+            if end - pos == 3:
+                first = data[pos] | 32
+                second = data[pos + 1] | 32
+                third = data[pos + 2] | 32
+                if ((first == 110 and second == 97 and third == 110)    # nan
+                        or (first == 105 and second == 110 and third == 102)):  # inf
+                    mask |= 4
+        return mask
+
+    @njit(cache=True)
+    def _classify_columns_bytes(data, offsets, num_columns):
+        """
+        Classifies all columns in one fused pass over row-major samples.
+
+        data concatenates every sampled value (row by row) as uint8,
+        offsets[i]:offsets[i+1] delimits value i, which belongs to column
+        i % num_columns. Returns one index into 'blds' per column.
+        Columns already decided as strings are skipped, and the scan
+        stops early once every column is decided.
+        """
+        flags = np.full((num_columns, 3), True)
+        undecided = num_columns
+        for i in range(offsets.shape[0] - 1):
+            start = offsets[i]
+            end = offsets[i + 1]
+            if start == end:
+                continue  # empty values carry no type information
+            column = i % num_columns
+            if not (flags[column, 0] or flags[column, 1] or flags[column, 2]):
+                continue
+            mask = _value_type_mask(data, start, end)
+            flags[column, 0] &= mask & 1 != 0
+            flags[column, 1] &= mask & 2 != 0
+            flags[column, 2] &= mask & 4 != 0
+            if not (flags[column, 0] or flags[column, 1] or flags[column, 2]):
+                undecided -= 1
+                if undecided == 0:
+                    break
+        codes = np.empty(num_columns, dtype=np.int8)
+        for column in range(num_columns):
+            if flags[column, 0]:
+                codes[column] = 0
+            elif flags[column, 1]:
+                codes[column] = 1
+            elif flags[column, 2]:
+                codes[column] = 2
+            else:
+                codes[column] = 3
+        return codes
+
+
+def infer_column_types(data_samples, num_columns):
     """
-    Infers the data type of a column based on its values.
-    
+    Infers the data type of every column from the sampled rows.
+
     Parameters:
-    values (list): A list of strings representing the values in a column.
-    
+    data_samples (list): Sample rows, each a list of string values.
+    num_columns (int): Number of columns, taken from the header.
+
     Returns:
-    str: A single character representing the inferred data type:
+    list: One character per column:
         'd' for DoubleColumn (floating point numbers),
         'l' for LongColumn (integer numbers),
         's' for StringColumn (text),
         'b' for BoolColumn (true/false).
-    
-    The function determines the type as follows:
-        - If all values can be interpreted as booleans ('true' or 'false'), it returns 'b'.
-        - If all values can be interpreted as integers, it returns 'l'.
-        - If all values can be interpreted as floats, it returns 'd'.
-        - Otherwise, it returns 's' for strings.
-    
-    Note:
-    - Empty values are ignored in type determination.
-    - The function performs case-insensitive checks for boolean values.
-    """
-    is_float = True
-    is_int = True
-    is_bool = True
-
-    for value in values:
-        # Handle empty values
-        if value == '':
-            continue
-        
-        # Check if value is boolean
-        if value.lower() in ('true', 'false'):
-            continue
-        is_bool = False
 
-        # Check if value is integer
-        try:
-            int(value)
-        except ValueError:
-            is_int = False
-
-        # Check if value is float
-        try:
-            float(value)
-        except ValueError:
-            is_float = False
+    All columns are classified in a single pass over the rows, keeping
+    per-column bool/int/float flags instead of transposing the samples;
+    columns already decided as strings are skipped. Empty values are
+    ignored, and the boolean check is case-insensitive. When numba is
+    available the pass runs in the compiled byte classifier.
+    """
+    if njit is not None:
+        buffer = bytearray()
+        offsets = np.zeros(len(data_samples) * num_columns + 1, dtype=np.int64)
+        i = 0
+        for row in data_samples:
+            for column in range(num_columns):
+                if column < len(row):
+                    buffer.extend(row[column].encode())
+                i += 1
+                offsets[i] = len(buffer)
+        data = np.frombuffer(bytes(buffer), dtype=np.uint8)
+        codes = _classify_columns_bytes(data, offsets, num_columns)
+        return ['blds'[code] for code in codes]
+
+    flags = [[True, True, True] for _ in range(num_columns)]
+    undecided = num_columns
+    for row in data_samples:
+        for column, value in enumerate(row[:num_columns]):
+            is_bool, is_int, is_float = flags[column]
+            if value == '' or not (is_bool or is_int or is_float):
+                continue
+            if is_bool and value.lower() not in _BOOL_SET:
+                flags[column][0] = False
+            if is_int and not _INT_MATCH(value):
+                flags[column][1] = False
+            if is_float and not _FLOAT_MATCH(value):
+                flags[column][2] = False
+            if not any(flags[column]):
+                undecided -= 1
+        if undecided == 0:
+            break
+    return ['b' if is_bool else 'l' if is_int else 'd' if is_float else 's'
+            for is_bool, is_int, is_float in flags]
+
+
+def postprocess_csv(csv_file_path):
+    """
+    Prepends a type-hint row to a single CellProfiler output CSV.
 
-    if is_bool:
-        return 'b'
-    if is_int:
-        return 'l'
-    if is_float:
-        return 'd'
-    return 's'
+    The hint row is inferred from up to 10 sample rows and written in
+    front of the otherwise untouched file content. Files are independent,
+    so this can run in a worker process.
+    """
+    temp_file_path = csv_file_path + '.temp'
+
+    # Sample the header and up to 10 rows with plain line splits; the
+    # csv quote-handling state machine is only needed when a row holds
+    # quoted commas, which shows up as a column-count mismatch below
+    with open(csv_file_path, mode='r', buffering=65536, newline='') as infile:
+        header = infile.readline().rstrip('\r\n').split(',')
+        data_samples = []
+        for _ in range(10):
+            line = infile.readline()
+            if not line:
+                break  # End of file reached
+            data_samples.append(line.rstrip('\r\n').split(','))
+
+    if any(len(row) != len(header) for row in data_samples):
+        # Fall back to a real csv parse for files with quoted commas
+        with open(csv_file_path, mode='r', newline='') as infile:
+            reader = csv.reader(infile)
+            header = next(reader)
+            data_samples = []
+            try:
+                for _ in range(10):
+                    data_samples.append(next(reader))
+            except StopIteration:
+                pass  # End of file reached
+
+    # Infer type hints in one pass over the sample rows
+    type_hints = infer_column_types(data_samples, len(header))
+    type_hints[0] = f'# header {type_hints[0]}'
+
+    # Write the type hint line, then stream the original file
+    # byte-for-byte instead of re-parsing it through csv
+    with open(temp_file_path, mode='wb') as outfile:
+        outfile.write((','.join(type_hints) + '\n').encode('utf-8'))
+        with open(csv_file_path, mode='rb') as infile:
+            shutil.copyfileobj(infile, outfile, 1024 * 1024)
+
+    # Replace the original file with the updated file
+    os.replace(temp_file_path, csv_file_path)
+
+
+def _materialize(source, destination):
+    """
+    Makes source available at destination without copying bytes when
+    possible: hardlink on the same filesystem, copy otherwise.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy(source, destination)
 
 
 def parse_cellprofiler_parameters(bj, cppipe, tmpdir):
@@ -99,57 +288,133 @@ def parse_cellprofiler_parameters(bj, cppipe, tmpdir):
 
     mod_cppipe = os.path.join(tmpdir, os.path.basename(cppipe))
 
+    # Fast path: with default parameters the rendered pipeline is
+    # identical to the file on disk, so copy it instead of parsing.
+    # Reading the raw text is far cheaper than a pipeline load.
+    with open(cppipe) as pipeline_file:
+        raw_text = pipeline_file.read()
+    needs_load = bj.parameters.metric_channels != '1,2,3' or any(
+        mask_key in raw_text
+        for mask_key in MASK_INDICES.values()
+        if getattr(bj.parameters, PARAMETER_SUFFIXES[mask_key]) != mask_key)
+    if not needs_load:
+        print("Using the pipeline as-is since all parameters are default.")
+        _materialize(cppipe, mod_cppipe)
+        return mod_cppipe
+
+    # Check the pipeline cache before paying for a full load/modify/dump
+    cache_tag = "|".join((
+        str(os.path.getmtime(cppipe)),
+        bj.parameters.nuclei_mask_suffix,
+        bj.parameters.cells_mask_suffix,
+        bj.parameters.metric_channels,
+    ))
+    cache_key = hashlib.blake2b(cache_tag.encode()).hexdigest()
+    cached_cppipe = os.path.join(CPPIPE_CACHE_DIR, f"{cache_key}.cppipe")
+    if os.path.exists(cached_cppipe):
+        try:
+            _materialize(cached_cppipe, mod_cppipe)
+        except FileNotFoundError:
+            # A concurrent job evicted the entry between the existence
+            # check and the link/copy; render the pipeline ourselves
+            pass
+        else:
+            print(f"Reusing cached pipeline {cached_cppipe}")
+            return mod_cppipe
+
+    # Importing cellprofiler_core pulls in a large dependency tree, so
+    # only pay for it when a pipeline actually needs rendering; argument
+    # parsing, error paths and the fast paths above never import it
+    import cellprofiler_core.pipeline
+    import cellprofiler_core.preferences
+
+    cellprofiler_core.preferences.set_headless()
+
     # Load the cppipe
     pipeline = cellprofiler_core.pipeline.Pipeline()
     pipeline.load(cppipe)
 
+    # Fetch the module list once instead of re-invoking the accessor
+    modules = pipeline.modules()
+
     # Override mask names in the names_and_types module
-    names_and_types_module = pipeline.modules()[NAMES_AND_TYPES_MODULE_INDEX]
+    names_and_types_module = modules[NAMES_AND_TYPES_MODULE_INDEX]
 
-    # Loop through mask indices to update the values
+    # Loop through mask indices to update the values, reading and writing
+    # each setting once and skipping writes that would not change anything
     for index, mask_key in MASK_INDICES.items():
-        pipeline_value = names_and_types_module.setting(index).get_value()
+        setting = names_and_types_module.setting(index)
+        pipeline_value = setting.get_value()
         param_suffix = getattr(bj.parameters, PARAMETER_SUFFIXES[mask_key])
         new_value = pipeline_value.replace(mask_key, param_suffix)
-        print(f"Changing setting at index {index}: {pipeline_value} to {new_value}")
-        names_and_types_module.setting(index).set_value(new_value)
+        if new_value != pipeline_value:
+            print(f"Changing setting at index {index}: {pipeline_value} to {new_value}")
+            setting.set_value(new_value)
 
     # Check if metric_channels is equal to the default value
     if bj.parameters.metric_channels == '1,2,3':
         print("Skipping channel modification since metric_channels is equal to the default value.")
     else:
-        channel_settings = pipeline.modules()[4]  # Assuming channels are in module 4
+        channel_settings = modules[4]  # Assuming channels are in module 4
         metric_channels = [int(ch) for ch in bj.parameters.metric_channels.split(',')] # split list
         num_channels = len(metric_channels) # total amount
         cur_channels = channel_settings.setting(20).get_value() # current configured
         print(f"Number of metric channels from parameters: {num_channels}")
         print(f"Current configured channels: {cur_channels}")
         # First, adjust the number of channels
+        channels = channel_settings.channels
         if num_channels > cur_channels:
             for _ in range(num_channels - cur_channels):
                 channel_settings.add_channel()
             print(f"Added {num_channels - cur_channels} channels.")
         elif num_channels < cur_channels:
             for _ in range(cur_channels - num_channels):
-                channel_settings.channels.remove(channel_settings.channels[-1])
+                channels.remove(channels[-1])
             print(f"Removed {cur_channels - num_channels} channels.")
         # Then, set the values of the channels and their names
         images_list = []
         for i, value in enumerate(metric_channels):
-            channel = channel_settings.channels[i]
+            channel = channels[i]
             channel.channel_choice.set_value(value)
             channel_name = f'Channel{value}'
             channel.settings[2].set_value(channel_name)
             print(f"Set channel {i} to value {value} and name to '{channel_name}'.")
             images_list.append(channel_name)
         # Finally, adjust the images selected for measurement in Module MeasureObjectIntensity
-        measure_object_intensity = pipeline.modules()[6]
+        measure_object_intensity = modules[6]
         measure_object_intensity.images_list.set_value(images_list)
 
     # Save the modified pipeline to a new file
     with open(mod_cppipe, 'w+') as dumpfile:
         pipeline.dump(dumpfile)
 
+    # Store the rendered pipeline in the cache, evicting the oldest
+    # entries once the cap is reached. The cache dir is shared between
+    # concurrent jobs, so publish under a unique temp name and rename it
+    # into place; never rewrite an existing entry, since cache-hit jobs
+    # hold live hardlinks to its inode
+    os.makedirs(CPPIPE_CACHE_DIR, exist_ok=True)
+    if not os.path.exists(cached_cppipe):
+        cache_tmp = os.path.join(
+            CPPIPE_CACHE_DIR, f".{cache_key}.{os.getpid()}.tmp")
+        _materialize(mod_cppipe, cache_tmp)
+        os.rename(cache_tmp, cached_cppipe)
+    cache_entries = []
+    for name in os.listdir(CPPIPE_CACHE_DIR):
+        if name.endswith('.tmp'):
+            continue  # another job is still publishing this entry
+        entry = os.path.join(CPPIPE_CACHE_DIR, name)
+        try:
+            cache_entries.append((os.path.getmtime(entry), entry))
+        except FileNotFoundError:
+            pass  # evicted by a concurrent job
+    cache_entries.sort()
+    for _, stale_entry in cache_entries[:-CPPIPE_CACHE_SIZE]:
+        try:
+            os.remove(stale_entry)
+        except FileNotFoundError:
+            pass  # evicted by a concurrent job
+
     return mod_cppipe
 
 
@@ -177,16 +442,13 @@ def main(argv):
             problem_cls, bj, is_2d=True, **bj.flags)
 
         # MAKE SURE TMP PATH IS UNIQUE
-        timestamp = int(time.time() * 1000)
-        try:            
-            tmp_path += f"/{timestamp}"  # timestamp in ms
-            os.mkdir(tmp_path)  # setup tmp
-        except FileExistsError:
-            timestamp = int(time.time() * 10000)
-            tmp_path += f"/{timestamp}"  # timestamp in ms
-            os.mkdir(tmp_path)  # setup tmp
+        # mkdtemp creates the directory atomically, so no collision
+        # handling is needed
+        tmp_path = tempfile.mkdtemp(prefix=f"{time.time_ns()}_", dir=tmp_path)
+        timestamp = os.path.basename(tmp_path)
 
         pipeline = "/app/FullMeasurementsNucleiCell.cppipe"
+        pipeline_stem = os.path.splitext(os.path.basename(pipeline))[0]
         # ---------------------------------------------------------------- #
         # ----------------- SETUP ARGS & PATHS // END ------------------- ##
         # ---------------------------------------------------------------- #
@@ -205,7 +467,7 @@ def main(argv):
             "cellprofiler", "-c", "-r", "-p", mod_pipeline,
             "-i", in_path, "-o", out_path, "-t", tmp_path,
         ]
-        status = run(" ".join(shArgs), shell=True)
+        status = run(shArgs, shell=False)
 
         if status.returncode != 0:
             err_desc = "Failed to execute the CellProfiler pipeline: {} (return code: {})".format(
@@ -214,9 +476,13 @@ def main(argv):
             raise ValueError(err_desc)
         else:
             # Move the modified pipeline file from tmp_path to out_path
-            mod_pipeline_basename = os.path.basename(mod_pipeline)
-            mod_pipeline_unique_name = f"{mod_pipeline_basename[:-7]}_{timestamp}.cppipe"
-            shutil.move(mod_pipeline, os.path.join(out_path, mod_pipeline_unique_name))
+            mod_pipeline_unique_name = f"{pipeline_stem}_{timestamp}.cppipe"
+            mod_pipeline_dest = os.path.join(out_path, mod_pipeline_unique_name)
+            try:
+                os.rename(mod_pipeline, mod_pipeline_dest)
+            except OSError:
+                # tmp and output dir are on different filesystems
+                shutil.move(mod_pipeline, mod_pipeline_dest)
         # ---------------------------------------------------------------- #
         # ---------------- RUN CELLPROFILER HEADLESS // END ------------- ##
         # ---------------------------------------------------------------- #
@@ -224,47 +490,16 @@ def main(argv):
         # ---------------------------------------------------------------- #
         # ----------------- POSTPROCESS CSV // START -------------------- ##
         # ---------------------------------------------------------------- #
-        # Get a list of CSV files in the directory
-        csv_files = [f for f in os.listdir(out_path) if f.endswith('.csv')]
-        # Loop over each CSV file
-        for csv_file in csv_files:
-            csv_file_path = os.path.join(out_path, csv_file)
-            temp_file_path = csv_file_path + '.temp'
-
-            # Read the original CSV content
-            with open(csv_file_path, mode='r', newline='') as infile:
-                reader = csv.reader(infile)
-                _ = next(reader) # skip header
-                # Read up to 10 rows for type inference
-                data_samples = []
-                try:
-                    for _ in range(10):
-                        row = next(reader)
-                        data_samples.append(row)
-                except StopIteration:
-                    pass  # End of file reached
-
-            # Transpose the data to analyze columns
-            transposed_samples = list(zip(*data_samples))
-            
-            # Infer type hints based on the columns' data
-            type_hints = [infer_column_type(column) for column in transposed_samples]
-            type_hints[0] = f'# header {type_hints[0]}'
-
-            # Write the updated content to a new temporary file
-            with open(temp_file_path, mode='w', newline='') as outfile:
-                writer = csv.writer(outfile, delimiter=',')
-
-                # Write the type hint line
-                writer.writerow(type_hints)
-
-                # Write the original data from the original CSV
-                with open(csv_file_path, mode='r', newline='') as infile:
-                    reader = csv.reader(infile)
-                    writer.writerows(reader)  # Write remaining rows
-
-            # Replace the original file with the updated file
-            os.replace(temp_file_path, csv_file_path)
+        # Get the CSV files in the directory; scandir avoids a stat and a
+        # path join per entry compared to os.listdir
+        with os.scandir(out_path) as entries:
+            csv_entries = [entry for entry in entries
+                           if entry.is_file() and entry.name.endswith('.csv')]
+        # Post-process the CSV files in parallel; the files are
+        # independent, so one worker process per file scales with cores
+        with ProcessPoolExecutor(max_workers=min(8, os.cpu_count())) as executor:
+            list(executor.map(postprocess_csv,
+                              [entry.path for entry in csv_entries]))
         # ---------------------------------------------------------------- #
         # ----------------- POSTPROCESS CSV // END ---------------------- ##
         # ---------------------------------------------------------------- #